@@ -1,17 +1,24 @@
 import json
+import asyncio
+import hashlib
+import aiofiles
 from urllib.parse import urljoin
 from pathlib import Path
-from playwright.sync_api import Page, TimeoutError as PlaywrightTimeoutError
+from playwright.async_api import Page, TimeoutError as PlaywrightTimeoutError
 from langchain_core.runnables import RunnableConfig
 
 from agent.state import AgentState
-from agent.llm import get_structured_plan, get_agent_action, get_research_analysis, get_updated_plan
-from browser.utils import resize_image_if_needed, simplify_page_for_llm
-from tavily import TavilyClient
-from config.settings import TAVILY_API_KEY
+from agent.llm import (
+    get_structured_plan, get_agent_action, get_failure_critique, get_research_analysis, get_updated_plan
+)
+from browser.utils import compress_screenshot, simplify_page_for_llm
+from tavily import AsyncTavilyClient
+from config.settings import (
+    TAVILY_API_KEY, SCREENSHOT_CLIP_TO_ELEMENTS, MAX_PROMPT_ELEMENTS, SEARCH_CACHE_TTL, search_cache
+)
 from langgraph.graph import StateGraph
 
-tavily_client = TavilyClient(api_key=TAVILY_API_KEY) if TAVILY_API_KEY else None
+tavily_client = AsyncTavilyClient(api_key=TAVILY_API_KEY) if TAVILY_API_KEY else None
 
 push_status_update = None
 
@@ -25,14 +32,19 @@ def get_page_from_config(config: RunnableConfig) -> Page:
         raise ValueError("Playwright Page object not found in configuration.")
     return page
 
-def planning_node(state: AgentState, config: RunnableConfig) -> AgentState:
+def format_plan(plan_details: dict) -> str:
+    # Built once per plan change and reused by the summary and every agent prompt
+    return "\n".join(f"  - {step}" for step in plan_details.get('plan', []))
+
+async def planning_node(state: AgentState, config: RunnableConfig) -> AgentState:
     page = get_page_from_config(config)
     state['url'] = page.url 
     if push_status_update:
         push_status_update(state['job_id'], "planning_started")
     
-    plan_details = get_structured_plan(state['query'], state['provider'], state['url'])
+    plan_details = await get_structured_plan(state['query'], state['provider'], state['url'])
     state['plan_details'] = plan_details
+    state['formatted_plan'] = format_plan(plan_details)
     
     if push_status_update:
         push_status_update(state['job_id'], "plan_generated", {"plan": plan_details})
@@ -41,12 +53,12 @@ def planning_node(state: AgentState, config: RunnableConfig) -> AgentState:
         f"[Plan Generated]\n"
         f"Objective: {plan_details.get('objective', 'Not specified')}\n"
         f"Intent: {plan_details.get('intent', 'Not specified')}\n"
-        f"Plan:\n" + "\n".join([f"  - {step}" for step in plan_details.get('plan', [])])
+        f"Plan:\n" + state['formatted_plan']
     )
     state['execution_summary'].append(summary)
     return state
 
-def agent_reasoning_node(state: AgentState, config: RunnableConfig) -> AgentState:
+async def agent_reasoning_node(state: AgentState, config: RunnableConfig) -> AgentState:
     page = get_page_from_config(config)
     job_id = state['job_id']
     if push_status_update:
@@ -59,24 +71,29 @@ def agent_reasoning_node(state: AgentState, config: RunnableConfig) -> AgentStat
     else:
         state['current_task'] = "All plan steps are complete. The final task is to finish the job."
 
-    screenshot_path = state['job_artifacts_dir'] / f"{state['step']:02d}_step.png"
-    page.screenshot(path=screenshot_path, full_page=False)
-    resize_image_if_needed(screenshot_path)
+    # Label elements first so the screenshot can be clipped to the region they occupy
+    simplified_elements, clip = await simplify_page_for_llm(page, max_elements=MAX_PROMPT_ELEMENTS)
+
+    # Capture to memory, compress off the loop, then write the file once
+    screenshot_bytes = await page.screenshot(full_page=False, clip=clip if SCREENSHOT_CLIP_TO_ELEMENTS else None)
+    screenshot_bytes, suffix = await asyncio.to_thread(compress_screenshot, screenshot_bytes)
+    # Retries re-capture the same step; a distinct name per attempt keeps every file write-once (served as immutable)
+    step_prefix = f"{state['step']:02d}_step"
+    attempt = sum(Path(p).name.startswith(step_prefix) for p in state['screenshots'])
+    screenshot_path = state['job_artifacts_dir'] / f"{step_prefix}{f'_retry{attempt}' if attempt else ''}{suffix}"
+    async with aiofiles.open(screenshot_path, "wb") as f:
+        await f.write(screenshot_bytes)
     
-    relative_path = Path("screenshots") / job_id / f"{state['step']:02d}_step.png"
+    relative_path = Path("screenshots") / job_id / screenshot_path.name
     state['screenshots'].append(relative_path.as_posix())
     
     # NEW: Push status for screenshot to allow dynamic loading in UI
     if push_status_update:
         push_status_update(job_id, "screenshot_taken", {"step": state['step'], "path": relative_path.as_posix()})
 
-    state['page_content'] = page.content()
     state['url'] = page.url
     
-    simplified_elements, modified_html = simplify_page_for_llm(state['page_content'])
-    if modified_html:
-        page.set_content(modified_html)  # FIX: Add this to apply agent-id to live page
-    action_response = get_agent_action(state, simplified_elements)
+    action_response = await get_agent_action(state, simplified_elements)
     
     thought = action_response.get("thought", "No thought provided.")
     if push_status_update:
@@ -84,10 +101,9 @@ def agent_reasoning_node(state: AgentState, config: RunnableConfig) -> AgentStat
         
     state['last_action'] = action_response.get("action", {})
     state['execution_summary'].append(f"\n[Step {state['step']}] Task: {state['current_task']}\n  -> Thought: {thought}")
-    state['modified_html_for_action'] = modified_html
     
     return state
-def execute_action_node(state: AgentState, config: RunnableConfig) -> AgentState:
+async def execute_action_node(state: AgentState, config: RunnableConfig) -> AgentState:
     page = get_page_from_config(config)
     action = state.get('last_action', {})
     job_id = state['job_id']
@@ -108,29 +124,29 @@ def execute_action_node(state: AgentState, config: RunnableConfig) -> AgentState
             if action_type in ["click", "press_enter"]:
                 selector = f"[agent-id='{action['id']}']"
                 element = page.locator(selector).first
-                element.wait_for(state='visible', timeout=30000)  # IMPROVE: Wait for visibility before action
+                await element.wait_for(state='visible', timeout=30000)  # IMPROVE: Wait for visibility before action
                 
                 # FIX: Remove expect_navigation; handle dynamically
                 if action_type == "click":
-                    element.click(timeout=30000)  # Increased timeout
+                    await element.click(timeout=30000)  # Increased timeout
                 elif action_type == "press_enter":
-                    element.press('Enter', timeout=30000)
-                page.wait_for_load_state('domcontentloaded', timeout=30000)  # Wait after action
+                    await element.press('Enter', timeout=30000)
+                await page.wait_for_load_state('domcontentloaded', timeout=30000)  # Wait after action
 
             elif action_type == "fill":
                 selector = f"[agent-id='{action['id']}']"
                 element = page.locator(selector).first
-                element.wait_for(state='visible', timeout=30000)
-                element.fill(action["text"], timeout=30000)
+                await element.wait_for(state='visible', timeout=30000)
+                await element.fill(action["text"], timeout=30000)
                 
             elif action_type == "scroll":
                 direction = action.get("direction", "down")
                 scroll_amount = "window.innerHeight * 0.8" if direction == "down" else "-window.innerHeight * 0.8"
-                page.evaluate(f"window.scrollBy(0, {scroll_amount})")
-                page.wait_for_timeout(2000)  # Increased for stability
+                await page.evaluate(f"window.scrollBy(0, {scroll_amount})")
+                await page.wait_for_timeout(2000)  # Increased for stability
             
             elif action_type == "wait":
-                page.wait_for_timeout(10000)  # Increased to 10s for better loading
+                await page.wait_for_timeout(10000)  # Increased to 10s for better loading
 
             elif action_type == "extract":
                 items = action.get("items", [])
@@ -138,7 +154,7 @@ def execute_action_node(state: AgentState, config: RunnableConfig) -> AgentState
                 if push_status_update:
                     push_status_update(job_id, "partial_result", {"items": items})
             
-            page.wait_for_timeout(5000)  # General post-action wait, increased
+            await page.wait_for_timeout(5000)  # General post-action wait, increased
             
         except PlaywrightTimeoutError as e:
             error_message = str(e).splitlines()[0]
@@ -159,45 +175,64 @@ def execute_action_node(state: AgentState, config: RunnableConfig) -> AgentState
     if outcome == "Success":
         state['step'] += 1  # Advance even after retry success
     
-    state['history'] = state['history'][-5:]
-    
     return state
 
-def researcher_node(state: AgentState, config: RunnableConfig) -> AgentState:
+async def web_search(query: str) -> dict:
+    # Same task on the same site yields the same suggestions; reuse them across retries and jobs
+    cache_key = "tavily:" + hashlib.sha256(query.encode("utf-8")).hexdigest()
+    if search_cache is not None:
+        cached = await asyncio.to_thread(search_cache.get, cache_key)  # SQLite I/O stays off the event loop
+        if cached is not None:
+            return cached
+
     if not tavily_client:
-        state['research_summary'] = "Tavily API key not configured. Skipping research."
-        return state
+        raise RuntimeError("Tavily API key not configured.")
+    response = await tavily_client.search(query=query, search_depth="advanced")
+    if search_cache is not None:
+        await asyncio.to_thread(search_cache.set, cache_key, response, expire=SEARCH_CACHE_TTL)
+    return response
 
+async def researcher_node(state: AgentState, config: RunnableConfig) -> AgentState:
     query = f"How to achieve this task: '{state['current_task']}' on the website {state['url']}?"  # FIX: Remove "using Playwright and CSS selectors" to avoid mismatch
     
     if push_status_update:
         push_status_update(state['job_id'], "research_started", {"query": query})
     
-    try:
-        response = tavily_client.search(query=query, search_depth="advanced")
-        context = [{"url": obj["url"], "content": obj["content"]} for obj in response.get("results", [])]
-        
-        analysis = get_research_analysis(state, context, state['provider'])
-        state['research_summary'] = analysis
-    except Exception as e:
-        state['research_summary'] = f"Research failed: {str(e)}"
+    # The self-critique needs no search results, so overlap both round-trips
+    critique, response = await asyncio.gather(
+        get_failure_critique(state, state['provider']),
+        web_search(query),
+        return_exceptions=True
+    )
+    if isinstance(critique, Exception):
+        critique = ""
+
+    if isinstance(response, Exception):
+        state['research_summary'] = critique or f"Research failed: {str(response)}"
+    else:
+        try:
+            context = [{"url": obj["url"], "content": obj["content"]} for obj in response.get("results", [])]
+            state['research_summary'] = await get_research_analysis(state, context, critique, state['provider'])
+        except Exception as e:
+            state['research_summary'] = critique or f"Research failed: {str(e)}"
 
     if push_status_update:
         push_status_update(state['job_id'], "research_complete", {"summary": state['research_summary']})
     
     return state
 
-def plan_updater_node(state: AgentState, config: RunnableConfig) -> AgentState:
+async def plan_updater_node(state: AgentState, config: RunnableConfig) -> AgentState:
     if push_status_update:
         push_status_update(state['job_id'], "updating_plan")
 
-    new_plan_details = get_updated_plan(state, state['provider'])
+    new_plan_details = await get_updated_plan(state, state['provider'])
     state['plan_details'] = new_plan_details
+    state['formatted_plan'] = format_plan(new_plan_details)
     
     if push_status_update:
         push_status_update(state['job_id'], "plan_updated", {"plan": new_plan_details})
         
-    state['execution_summary'].append(f"\n[Plan Updated after Research]\nNew Plan:\n" + "\n".join([f"  - {step}" for step in new_plan_details.get('plan', [])]))
+    state['execution_summary'].append(f"\n[Plan Updated after Research]\nNew Plan:\n" + state['formatted_plan'])
     return state
 
 def validator_and_router_node(state: AgentState) -> str:
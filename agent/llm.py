@@ -1,123 +1,279 @@
 import json
 import base64
-import re
+import asyncio
+import hashlib
+import functools
 from pathlib import Path
-from typing import List, Dict
-import time
+from typing import List, Dict, Deque, Optional
+import orjson
+import json_repair
 from agent.state import AgentState
+from agent.semantic_cache import semantic_cache
 from agent.prompts import (
-    PLANNER_PROMPT, AGENT_PROMPT, RESEARCHER_PROMPT, PLAN_UPDATER_PROMPT
+    PLANNER_PROMPT_FN, AGENT_PROMPT_FN, RESEARCHER_PROMPT_FN, CRITIC_PROMPT_FN, PLAN_UPDATER_PROMPT_FN
 )
 from config.settings import (
-    anthropic_client, groq_client, openai_client,
-    ANTHROPIC_MODEL, GROQ_MODEL, OPENAI_MODEL
+    anthropic_client, groq_client, openai_client, llm_cache,
+    ANTHROPIC_MODEL, GROQ_MODEL, OPENAI_MODEL, MAX_HISTORY_CHARS, LLM_CACHE_TTL
 )
 
 LLMProvider = str
 
-def get_llm_response(system_prompt: str, prompt: str, provider: LLMProvider, images: List[Path]) -> str:
+PROVIDER_MODELS = {"anthropic": ANTHROPIC_MODEL, "openai": OPENAI_MODEL, "groq": GROQ_MODEL}
+LLM_CACHE_STATS = {"hits": 0, "misses": 0}
+IMAGE_MEDIA_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+
+# JSON mode requires "json" in the prompt and rejects prose replies, so only JSON calls (stop_at_json) request it
+def json_response_format(stop_at_json: bool) -> dict:
+    return {"response_format": {"type": "json_object"}} if stop_at_json else {}
+
+@functools.lru_cache(maxsize=64)
+def _encode_image(path_str: str, mtime_ns: int, size: int) -> str:
+    # mtime/size are part of the cache key so a rewritten screenshot is re-encoded
+    with open(path_str, "rb") as f: return base64.b64encode(f.read()).decode("utf-8")
+
+async def encode_image(img_path: Path) -> str:
+    stat = Path(img_path).stat()
+    return await asyncio.to_thread(_encode_image, str(img_path), stat.st_mtime_ns, stat.st_size)
+
+def llm_cache_key(system_prompt: str, prompt: str, provider: LLMProvider, images_b64: List[str]) -> str:
+    key_data = {
+        "provider": provider,
+        "model": PROVIDER_MODELS.get(provider, provider),
+        "system": system_prompt,
+        "prompt": prompt,
+        "images": [hashlib.sha256(img_data.encode("utf-8")).hexdigest() for img_data in images_b64],
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def cached_llm_response(func):
+    # Only deterministic (temperature 0) completions are safe to replay from the cache
+    @functools.wraps(func)
+    async def wrapper(system_prompt: str, prompt: str, provider: LLMProvider, images: List[Path], temperature: float = 0.0, stop_at_json: bool = False) -> str:
+        if llm_cache is None or temperature != 0:
+            return await func(system_prompt, prompt, provider, images, temperature, stop_at_json)
+
+        images_b64 = [await encode_image(img_path) for img_path in images]
+        key = llm_cache_key(system_prompt, prompt, provider, images_b64)
+        # diskcache is SQLite underneath; keep its I/O (and lock waits) off the event loop
+        cached = await asyncio.to_thread(llm_cache.get, key)
+        if cached is not None:
+            LLM_CACHE_STATS["hits"] += 1
+            return cached
+
+        LLM_CACHE_STATS["misses"] += 1
+        response_text = await func(system_prompt, prompt, provider, images, temperature, stop_at_json)
+        # JSON calls: don't replay truncated or malformed output, it would only ever produce the fallback action.
+        # Prose calls (critique, research analysis): any non-empty reply is usable.
+        if stop_at_json:
+            cacheable = parse_json_object(response_text) is not None
+        else:
+            cacheable = bool(response_text and response_text.strip())
+        if cacheable:
+            await asyncio.to_thread(llm_cache.set, key, response_text, expire=LLM_CACHE_TTL)
+        return response_text
+    return wrapper
+
+def format_history(history: Deque[str], max_chars: int = MAX_HISTORY_CHARS) -> str:
+    # Keep the most recent entries that fit in the character budget
+    kept, used = [], 0
+    for entry in reversed(history):
+        if used + len(entry) > max_chars:
+            if not kept: kept.append(entry[:max_chars])
+            break
+        kept.append(entry)
+        used += len(entry) + 1
+    return "\n".join(reversed(kept)) or "No actions taken yet."
+
+class JsonObjectEndDetector:
+    # Incrementally scans streamed text and reports when the first top-level JSON object closes
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: str) -> bool:
+        for char in chunk:
+            if self.in_string:
+                if self.escaped: self.escaped = False
+                elif char == '\\': self.escaped = True
+                elif char == '"': self.in_string = False
+            elif char == '"' and self.depth > 0:
+                self.in_string = True
+            elif char == '{':
+                self.depth += 1
+            elif char == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+@cached_llm_response
+async def get_llm_response(system_prompt: str, prompt: str, provider: LLMProvider, images: List[Path], temperature: float = 0.0, stop_at_json: bool = False) -> str:
     for attempt in range(3):  # IMPROVE: Add retries for LLM calls
         try:
             if provider == "anthropic":
                 if not anthropic_client: raise ValueError("Anthropic client not initialized.")
-                return call_anthropic(system_prompt, prompt, images)
+                return await call_anthropic(system_prompt, prompt, images, temperature, stop_at_json)
             elif provider == "openai":
                 if not openai_client: raise ValueError("OpenAI client not initialized.")
-                return call_openai(system_prompt, prompt, images)
+                return await call_openai(system_prompt, prompt, images, temperature, stop_at_json)
             elif provider == "groq":
                 if not groq_client: raise ValueError("Groq client not initialized.")
                 if images: raise ValueError("The configured Groq model does not support vision.")
-                return call_groq(system_prompt, prompt)
+                return await call_groq(system_prompt, prompt, temperature, stop_at_json)
             else:
                 raise ValueError(f"Unsupported LLM provider: {provider}")
         except Exception as e:
             if attempt == 2:
                 raise
-            time.sleep(2)  # Backoff
+            await asyncio.sleep(2)  # Backoff
 
-def call_anthropic(system_prompt: str, prompt: str, images: List[Path]) -> str:
+async def call_anthropic(system_prompt: str, prompt: str, images: List[Path], temperature: float = 0.0, stop_at_json: bool = False) -> str:
     messages = [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
     for img_path in images:
-        with open(img_path, "rb") as f: img_data = base64.b64encode(f.read()).decode("utf-8")
-        messages[0]["content"].append({"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": img_data}})
-    response = anthropic_client.messages.create(model=ANTHROPIC_MODEL, max_tokens=8192, system=system_prompt, messages=messages, timeout=60)  # Add timeout
+        img_data = await encode_image(img_path)
+        media_type = IMAGE_MEDIA_TYPES.get(Path(img_path).suffix.lower(), "image/png")
+        messages[0]["content"].append({"type": "image", "source": {"type": "base64", "media_type": media_type, "data": img_data}})
+    if stop_at_json:
+        # Stream and hang up as soon as the JSON object is complete; trailing tokens are never generated
+        chunks, detector = [], JsonObjectEndDetector()
+        async with anthropic_client.messages.stream(model=ANTHROPIC_MODEL, max_tokens=8192, temperature=temperature, system=system_prompt, messages=messages, timeout=60) as stream:
+            async for text in stream.text_stream:
+                chunks.append(text)
+                if detector.feed(text): break
+        return "".join(chunks)
+    response = await anthropic_client.messages.create(model=ANTHROPIC_MODEL, max_tokens=8192, temperature=temperature, system=system_prompt, messages=messages, timeout=60)  # Add timeout
     return response.content[0].text
 
-def call_openai(system_prompt: str, prompt: str, images: List[Path]) -> str:
+async def call_openai(system_prompt: str, prompt: str, images: List[Path], temperature: float = 0.0, stop_at_json: bool = False) -> str:
     messages = [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
     for img_path in images:
-        with open(img_path, "rb") as f: img_data = base64.b64encode(f.read()).decode("utf-8")
-        messages[0]["content"].append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img_data}"}})
-    response = openai_client.chat.completions.create(model=OPENAI_MODEL, max_tokens=8192, messages=[{"role": "system", "content": system_prompt}, *messages], response_format={"type": "json_object"}, timeout=60)
+        img_data = await encode_image(img_path)
+        media_type = IMAGE_MEDIA_TYPES.get(Path(img_path).suffix.lower(), "image/png")
+        messages[0]["content"].append({"type": "image_url", "image_url": {"url": f"data:{media_type};base64,{img_data}"}})
+    response = await openai_client.chat.completions.create(model=OPENAI_MODEL, max_tokens=8192, temperature=temperature, messages=[{"role": "system", "content": system_prompt}, *messages], timeout=60, stream=stop_at_json, **json_response_format(stop_at_json))
+    if stop_at_json:
+        return await read_stream_until_json(response)
     return response.choices[0].message.content
 
-def call_groq(system_prompt: str, prompt: str) -> str:
-    response = groq_client.chat.completions.create(model=GROQ_MODEL, max_tokens=8192, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}], response_format={"type": "json_object"}, timeout=60)
+async def call_groq(system_prompt: str, prompt: str, temperature: float = 0.0, stop_at_json: bool = False) -> str:
+    response = await groq_client.chat.completions.create(model=GROQ_MODEL, max_tokens=8192, temperature=temperature, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}], timeout=60, stream=stop_at_json, **json_response_format(stop_at_json))
+    if stop_at_json:
+        return await read_stream_until_json(response)
     return response.choices[0].message.content
 
-def extract_json_from_response(text: str) -> Dict:
+async def read_stream_until_json(stream) -> str:
+    # OpenAI-compatible chunk stream (OpenAI, Groq); closing it drops the connection early
+    chunks, detector = [], JsonObjectEndDetector()
+    try:
+        async for chunk in stream:
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if not text: continue
+            chunks.append(text)
+            if detector.feed(text): break
+    finally:
+        await stream.close()
+    return "".join(chunks)
+
+def _json_slice(text: str) -> Optional[str]:
     start_brace_index = text.find('{')
     if start_brace_index == -1:
-        raise ValueError(f"No JSON object found in the model's response: {text}")
-
+        return None
     end_brace_index = text.rfind('}')
     if end_brace_index == -1:
-        json_str = text[start_brace_index:]
-    else:
-        json_str = text[start_brace_index : end_brace_index + 1]
+        return text[start_brace_index:]
+    return text[start_brace_index : end_brace_index + 1]
 
+def parse_json_object(text: str) -> Optional[Dict]:
+    # Returns None when the response holds no usable JSON object
+    json_str = _json_slice(text)
+    if json_str is None:
+        return None
     try:
-        json_str_fixed = re.sub(r',\s*([\}\]])', r'\1', json_str)
-        
-        open_braces = json_str_fixed.count('{')
-        close_braces = json_str_fixed.count('}')
-        if open_braces > close_braces:
-            json_str_fixed += '}' * (open_braces - close_braces)
-
-        return json.loads(json_str_fixed)
-    except json.JSONDecodeError as e:
-        # IMPROVE: Fallback to empty action if invalid
-        print(f"Failed to decode JSON: {e}\nOriginal: {json_str}")
-        return {"thought": "Invalid response from LLM", "action": {"type": "wait"}}  # Fallback to prevent crash
+        parsed = orjson.loads(json_str)  # Fast path: well-formed JSON
+    except orjson.JSONDecodeError:
+        # Slow path: trailing commas, unbalanced braces, truncated output, ...
+        parsed = json_repair.loads(json_str)
+    return parsed if isinstance(parsed, dict) and parsed else None
+
+def extract_json_from_response(text: str) -> Dict:
+    json_str = _json_slice(text)
+    if json_str is None:
+        raise ValueError(f"No JSON object found in the model's response: {text}")
+
+    parsed = parse_json_object(json_str)
+    if parsed is not None:
+        return parsed
+    # IMPROVE: Fallback to empty action if invalid
+    print(f"Failed to decode JSON.\nOriginal: {json_str}")
+    return {"thought": "Invalid response from LLM", "action": {"type": "wait"}}  # Fallback to prevent crash
         
-def get_structured_plan(query: str, provider: LLMProvider, url: str) -> dict:
-    prompt = PLANNER_PROMPT.format(query=query, url=url)
+async def get_structured_plan(query: str, provider: LLMProvider, url: str) -> dict:
+    prompt = PLANNER_PROMPT_FN(query=query, url=url)
     system_prompt = "You are an expert planner. Respond ONLY with the JSON plan."
-    response_text = get_llm_response(system_prompt, prompt, provider, images=[])
+    response_text = await get_llm_response(system_prompt, prompt, provider, images=[], stop_at_json=True)
     return extract_json_from_response(response_text)
 
-def get_agent_action(state: AgentState, simplified_elements: str) -> dict:
-    prompt = AGENT_PROMPT.format(
+async def get_agent_action(state: AgentState, simplified_elements: str) -> dict:
+    prompt = AGENT_PROMPT_FN(
         query=state['query'],
-        plan="\n".join([f"- {step}" for step in state['plan_details'].get('plan', [])]),
+        plan=state['formatted_plan'],
         current_task=state['current_task'],
         url=state['url'],
-        history="\n".join(state['history']) or "No actions taken yet.",
+        history=format_history(state['history']),
         elements=simplified_elements or "No interactive elements found on the page."
     )
     system_prompt = "You are a web agent. Respond ONLY with your JSON thought and action."
-    screenshot_path = state['job_artifacts_dir'] / f"{state['step']:02d}_step.png"
-    response_text = get_llm_response(system_prompt, prompt, state['provider'], images=[screenshot_path])
-    return extract_json_from_response(response_text)
 
-def get_research_analysis(state: AgentState, context: list, provider: LLMProvider) -> str:
-    prompt = RESEARCHER_PROMPT.format(
+    # Near-identical element lists for the same task map to the same action; skip the vision call.
+    # Retries bypass the cache so a failing action is never replayed.
+    use_semantic_cache = semantic_cache is not None and state['retry_count'] == 0
+    if use_semantic_cache:
+        cache_key = (state['provider'], PROVIDER_MODELS.get(state['provider'], state['provider']), state['query'], state['current_task'])
+        cache_text = f"{state['url']}\n{simplified_elements}"
+        embedding, cached_action = await semantic_cache.lookup(cache_key, cache_text, simplified_elements)
+        if cached_action is not None:
+            return cached_action
+
+    screenshot_path = state['job_artifacts_dir'] / Path(state['screenshots'][-1]).name
+    response_text = await get_llm_response(system_prompt, prompt, state['provider'], images=[screenshot_path], stop_at_json=True)
+    action_response = extract_json_from_response(response_text)
+    if use_semantic_cache:
+        await semantic_cache.store(cache_key, embedding, action_response, simplified_elements)
+    return action_response
+
+async def get_failure_critique(state: AgentState, provider: LLMProvider) -> str:
+    prompt = CRITIC_PROMPT_FN(
+        query=state['query'],
+        current_task=state['current_task'],
+        action=json.dumps(state.get('last_action', {})),
+        error=state['last_error'],
+        history=format_history(state['history'])
+    )
+    system_prompt = "You are a critic for a web agent. Diagnose the failed step and respond with your critique as a plain string."
+    response_text = await get_llm_response(system_prompt, prompt, provider, images=[])
+    return response_text
+
+async def get_research_analysis(state: AgentState, context: list, critique: str, provider: LLMProvider) -> str:
+    prompt = RESEARCHER_PROMPT_FN(
         query=state['query'],
         current_task=state['current_task'],
         error=state['last_error'],
-        context=json.dumps(context, indent=2)
+        critique=critique or "No self-critique available.",
+        context="\n---\n".join(f"{obj['url']}\n{obj['content'][:2000]}" for obj in context) or "No search results."
     )
     system_prompt = "You are a research analyst. Analyze the provided context and suggest a concise, actionable solution. Respond with your analysis as a plain string."
-    response_text = get_llm_response(system_prompt, prompt, provider, images=[])
+    response_text = await get_llm_response(system_prompt, prompt, provider, images=[])
     return response_text
 
-def get_updated_plan(state: AgentState, provider: LLMProvider) -> dict:
-    prompt = PLAN_UPDATER_PROMPT.format(
-        plan=json.dumps(state['plan_details'], indent=2),
+async def get_updated_plan(state: AgentState, provider: LLMProvider) -> dict:
+    prompt = PLAN_UPDATER_PROMPT_FN(
+        plan=json.dumps(state['plan_details'], separators=(',', ':')),
         current_task=state['current_task'],
         error=state['last_error'],
         research_summary=state['research_summary']
     )
     system_prompt = "You are a planner. Update the provided JSON plan based on the research summary. Respond ONLY with the updated, valid JSON plan."
-    response_text = get_llm_response(system_prompt, prompt, provider, images=[])
+    response_text = await get_llm_response(system_prompt, prompt, provider, images=[], stop_at_json=True)
     return extract_json_from_response(response_text)
\ No newline at end of file
@@ -1,3 +1,21 @@
+from string import Formatter
+
+def compile_prompt(template: str):
+    # Split the template on its {placeholders} once; rendering is then a single join
+    parts = []
+    for literal_text, field_name, format_spec, conversion in Formatter().parse(template):
+        if format_spec or conversion:
+            raise ValueError(f"Unsupported placeholder in prompt template: {{{field_name}}}")
+        if literal_text:
+            parts.append((literal_text, None))
+        if field_name is not None:
+            parts.append((None, field_name))
+    parts = tuple(parts)
+
+    def render(**kwargs) -> str:
+        return "".join(text if field is None else str(kwargs[field]) for text, field in parts)
+    return render
+
 PLANNER_PROMPT = """
 You are an expert planner for a web automation agent. Your task is to decompose a user's objective into a structured, high-level plan.
 The plan must be broken down into clear, logical steps, but NOT overly detailed.
@@ -75,12 +93,15 @@ The user wants to "{query}".
 **Error Encountered:**
 "{error}"
 
+**Agent's Self-Critique of the Failure:**
+{critique}
+
 **Provided Web Search Results (Context):**
 {context}
 
 **Your Instructions:**
 1.  Review the agent's task and the error it encountered.
-2.  Read through the web search results to find relevant information (e.g., common website layouts, alternative methods).
+2.  Read through the agent's self-critique and the web search results to find relevant information (e.g., common website layouts, alternative methods).
 3.  Provide a concise, actionable summary for the planning agent. Your summary should directly help the agent retry the failed task using its available tools (fill, click, scroll, wait, etc.). Avoid technical details like CSS selectors.
     - **Good Summary Example:** "The search results suggest that the search bar on this website is usually at the top. The plan should be updated to scroll or wait if not visible, then fill and click."
     - **Bad Summary Example:** "The agent should try again."
@@ -88,6 +109,31 @@ The user wants to "{query}".
 **Respond with your analysis as a plain string. Be direct and helpful.**
 """
 
+CRITIC_PROMPT = """
+You are reviewing a failed step of a web automation agent. Diagnose why the action failed, without any outside research.
+
+**Original Goal:**
+The user wants to "{query}".
+
+**Agent's Current Task (The step that failed):**
+"{current_task}"
+
+**Action Attempted:**
+{action}
+
+**Error Encountered:**
+"{error}"
+
+**Recent Action History:**
+{history}
+
+**Your Instructions:**
+1.  Identify the most likely cause of the failure (e.g., wrong element, element not yet visible, popup in the way, page still loading).
+2.  Suggest how the agent could retry the task using its available tools (fill, click, scroll, wait, etc.). Avoid technical details like CSS selectors.
+
+**Respond with your critique as a short plain string.**
+"""
+
 PLAN_UPDATER_PROMPT = """
 You are a planner for a web automation agent. The agent failed a step and has conducted research to find a solution.
 Your task is to update the original plan based on the research summary.
@@ -111,4 +157,10 @@ Your task is to update the original plan based on the research summary.
 4.  Be precise but avoid technical details like CSS selectors; focus on actionable steps.
 
 **Response Format:** You MUST respond with a single, valid JSON object that contains the full, updated "plan" (a list of strings).
-"""
\ No newline at end of file
+"""
+
+PLANNER_PROMPT_FN = compile_prompt(PLANNER_PROMPT)
+AGENT_PROMPT_FN = compile_prompt(AGENT_PROMPT)
+RESEARCHER_PROMPT_FN = compile_prompt(RESEARCHER_PROMPT)
+CRITIC_PROMPT_FN = compile_prompt(CRITIC_PROMPT)
+PLAN_UPDATER_PROMPT_FN = compile_prompt(PLAN_UPDATER_PROMPT)
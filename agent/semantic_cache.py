@@ -0,0 +1,84 @@
+import re
+import json
+import asyncio
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from config.settings import SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_THRESHOLD
+
+# Only actions that are a pure function of the visible elements are safe to replay.
+# "extract" depends on page content, "finish" ends the job and "wait" is the parse-failure fallback;
+# "fill" carries job-specific text (search terms, generated credentials).
+CACHEABLE_ACTION_TYPES = {"click", "press_enter", "scroll"}
+
+CacheKey = Tuple[str, str, str, str]  # (provider, model, query, current_task): similarity only decides within one task
+
+ELEMENT_LINE_RE = re.compile(r"^\[([^\]]+)\] (.*)$")
+
+def element_at(simplified_elements: str, agent_id) -> Optional[str]:
+    # "<tag> text" of the labelled element with this agent-id, from the "[id] <tag> text" listing
+    for line in simplified_elements.splitlines():
+        match = ELEMENT_LINE_RE.match(line)
+        if match and match.group(1) == str(agent_id):
+            return match.group(2)
+    return None
+
+class SemanticActionCache:
+    def __init__(self, model_name: str, threshold: float):
+        self.model_name = model_name
+        self.threshold = threshold
+        self._model = None
+        self._indexes: Dict[CacheKey, Tuple["faiss.IndexFlatIP", List[str]]] = {}
+        self._lock = threading.Lock()
+
+    def _embed(self, text: str):
+        if self._model is None:
+            self._model = SentenceTransformer(self.model_name)
+        return self._model.encode([text], normalize_embeddings=True).astype("float32")
+
+    def _lookup(self, key: CacheKey, text: str, simplified_elements: str):
+        embedding = self._embed(text)
+        with self._lock:
+            index, entries = self._indexes.get(key, (None, []))
+            if index is None or index.ntotal == 0:
+                return embedding, None
+            scores, ids = index.search(embedding, 1)
+            if scores[0][0] < self.threshold:
+                return embedding, None
+            entry = json.loads(entries[ids[0][0]])
+        # agent-ids are positional: one inserted element shifts them, so only replay onto the same element
+        agent_id = entry["response"].get("action", {}).get("id")
+        if agent_id is not None and element_at(simplified_elements, agent_id) != entry["element"]:
+            return embedding, None
+        return embedding, entry["response"]
+
+    def _store(self, key: CacheKey, embedding, action_response: dict, simplified_elements: str):
+        agent_id = action_response.get("action", {}).get("id")
+        element = element_at(simplified_elements, agent_id) if agent_id is not None else None
+        if agent_id is not None and element is None:
+            return  # The model named an id that isn't on the page; nothing safe to replay
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes[key] = (faiss.IndexFlatIP(embedding.shape[1]), [])
+            index, entries = self._indexes[key]
+            index.add(embedding)
+            entries.append(json.dumps({"response": action_response, "element": element}))
+
+    async def lookup(self, key: CacheKey, text: str, simplified_elements: str):
+        # Embedding is CPU-bound; keep it off the event loop
+        return await asyncio.to_thread(self._lookup, key, text, simplified_elements)
+
+    async def store(self, key: CacheKey, embedding, action_response: dict, simplified_elements: str):
+        if action_response.get("action", {}).get("type") not in CACHEABLE_ACTION_TYPES:
+            return
+        await asyncio.to_thread(self._store, key, embedding, action_response, simplified_elements)
+
+semantic_cache: Optional[SemanticActionCache] = None
+
+try:
+    if SEMANTIC_CACHE_ENABLED:
+        import faiss
+        from sentence_transformers import SentenceTransformer
+        semantic_cache = SemanticActionCache(SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_THRESHOLD)
+except ImportError:
+    print("Warning: 'sentence-transformers' or 'faiss' not installed. Semantic action cache will be unavailable.")
@@ -1,4 +1,4 @@
-from typing import TypedDict, List, Dict, Any
+from typing import TypedDict, List, Dict, Any, Deque
 from pathlib import Path
 
 class AgentState(TypedDict):
@@ -10,12 +10,9 @@ class AgentState(TypedDict):
     
     # Planning & Task Management
     plan_details: Dict[str, Any]
+    formatted_plan: str  # Bulleted plan steps, rebuilt only when the plan changes
     current_task: str
 
-    # Browser & Page State
-    page_content: str
-    modified_html_for_action: str
-    
     # Results & Artifacts
     results: List[dict]
     generated_credentials: Dict[str, str]
@@ -25,7 +22,7 @@ class AgentState(TypedDict):
     # Execution Flow & History
     step: int
     max_steps: int
-    history: List[str]
+    history: Deque[str]  # Bounded deque: keeps only the most recent actions
     execution_summary: List[str]
     
     # Self-Healing & Retry Mechanism
@@ -0,0 +1,70 @@
+import asyncio
+from typing import List, Optional
+from playwright.async_api import async_playwright, Browser, Playwright
+
+from config.settings import BROWSER_POOL_SIZE
+
+class BrowserPool:
+    # Keeps warm Chromium processes so a job only pays for a fresh BrowserContext, not a browser launch
+    def __init__(self, size: int):
+        self.size = size
+        self._playwright: Optional[Playwright] = None
+        self._browsers: List[Browser] = []
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._start_lock = asyncio.Lock()
+
+    async def _launch(self) -> Browser:
+        browser = await self._playwright.chromium.launch(headless=True)
+        self._browsers.append(browser)
+        return browser
+
+    async def start(self):
+        async with self._start_lock:
+            if self._playwright:
+                return
+            self._playwright = await async_playwright().start()
+            try:
+                browsers = await asyncio.gather(*(self._launch() for _ in range(self.size)))
+            except Exception:
+                await self.close()  # Don't leave a started pool with no browsers in it
+                raise
+            for browser in browsers:
+                self._idle.put_nowait(browser)
+
+    async def acquire(self) -> Browser:
+        await self.start()
+        browser = await self._idle.get()
+        if not browser.is_connected():
+            # Chromium crashed or was killed while idle; replace it
+            if browser in self._browsers:
+                self._browsers.remove(browser)
+            try:
+                browser = await self._launch()
+            except Exception:
+                self._idle.put_nowait(browser)  # Keep the slot; the next acquire retries the launch
+                raise
+        return browser
+
+    async def release(self, browser: Browser):
+        # A browser is held by one job at a time, so any context still open here was orphaned
+        # (e.g. the job was cancelled mid new_context()); close it before the next job gets this browser
+        for context in list(browser.contexts):
+            try:
+                await context.close()
+            except Exception as e:
+                print(f"Warning: Could not close orphaned browser context. Error: {e}")
+        self._idle.put_nowait(browser)
+
+    async def close(self):
+        for browser in self._browsers:
+            try:
+                await browser.close()
+            except Exception as e:
+                print(f"Warning: Could not close pooled browser. Error: {e}")
+        self._browsers.clear()
+        self._idle = asyncio.Queue()
+        if self._playwright:
+            await self._playwright.stop()
+            self._playwright = None
+
+BROWSER_POOL = BrowserPool(BROWSER_POOL_SIZE)
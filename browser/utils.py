@@ -1,38 +1,75 @@
+import io
 import time
-from pathlib import Path
+from typing import Iterable, Optional
+from urllib.parse import urlsplit
 from PIL import Image
-from bs4 import BeautifulSoup
+from playwright.async_api import Page
 
 def get_current_timestamp():
     return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
-def resize_image_if_needed(image_path: Path):
+def compress_screenshot(image_bytes: bytes, quality: int = 80) -> tuple[bytes, str]:
+    # Downscale and re-encode as JPEG in memory: ~5-10x smaller than PNG, which shrinks the base64 payload sent to vision LLMs
     try:
-        with Image.open(image_path) as img:
+        with Image.open(io.BytesIO(image_bytes)) as img:
             if max(img.size) > 1024:
-                img.thumbnail((1024, 1024), Image.LANCZOS)
-                img.save(image_path)
+                img.thumbnail((1024, 1024), Image.BILINEAR)  # Adequate for an LLM downscale, cheaper than LANCZOS
+            out = io.BytesIO()
+            img.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue(), ".jpg"
     except Exception as e:
-        print(f"Warning: Could not resize image {image_path}. Error: {e}")
+        print(f"Warning: Could not resize screenshot. Error: {e}")
+        return image_bytes, ".png"
 
-def simplify_page_for_llm(page_content: str) -> tuple[str, str]:
-    soup = BeautifulSoup(page_content, "html.parser")
-    
-    # FIX: Remove destructive decompose; only remove non-essential if needed (e.g., scripts/styles break JS, so skip)
-    # for tag in soup.find_all(['script', 'style', 'svg']):  # Optional: Uncomment if you want to remove these, but test
-    #     tag.decompose()
+LABEL_ELEMENTS_JS = """
+({padding, maxElements}) => {
+    const els = Array.from(document.querySelectorAll('a, button, input, textarea, select'));
+    // Read every rect before writing any attribute so layout is computed once, not per element
+    const rects = els.map(el => el.getBoundingClientRect());
+    const vw = window.innerWidth, vh = window.innerHeight;
+    let left = vw, top = vh, right = 0, bottom = 0;
+    const out = [];
+    els.forEach((el, i) => {
+        const agentId = i + 1;
+        el.setAttribute('agent-id', agentId);
+        const text = (el.innerText || '').replace(/\\s+/g, ' ').trim()
+            || el.getAttribute('aria-label') || el.getAttribute('placeholder') || el.getAttribute('name') || '';
+        const r = rects[i];
+        const visible = r.width > 0 && r.height > 0 && r.bottom > 0 && r.right > 0 && r.top < vh && r.left < vw;
+        out.push([agentId, el.tagName.toLowerCase(), text.slice(0, 100), visible]);
+        if (visible) {
+            left = Math.min(left, r.left); top = Math.min(top, r.top);
+            right = Math.max(right, r.right); bottom = Math.max(bottom, r.bottom);
+        }
+    });
+    let clip = null;
+    if (right > left && bottom > top) {
+        const x = Math.max(0, left - padding), y = Math.max(0, top - padding);
+        clip = {x, y, width: Math.min(vw, right + padding) - x, height: Math.min(vh, bottom + padding) - y};
+    }
+    // Elements in the viewport first (stable, so document order is kept within each group), then cap the list
+    out.sort((a, b) => b[3] - a[3]);
+    return {elements: out.slice(0, maxElements), clip};
+}
+"""
 
-    interactive_elements = soup.find_all(['a', 'button', 'input', 'textarea', 'select'])
-    simplified_elements = []
-    
-    for i, element in enumerate(interactive_elements):
-        agent_id = str(i + 1)
-        element['agent-id'] = agent_id
-        
-        text = ' '.join(element.stripped_strings)
-        if not text:
-            text = element.get('aria-label') or element.get('placeholder') or element.get('name') or ''
-        
-        simplified_elements.append(f"[{agent_id}] <{element.name}> {text[:100]}")
+async def block_heavy_resources(page: Page, resource_types: Iterable[str], tracker_hosts: Iterable[str]):
+    # Skip images, fonts, media and trackers: the agent works from the labelled DOM, not from pixels of every asset
+    resource_types = frozenset(resource_types)
+    tracker_hosts = tuple(tracker_hosts)
+    tracker_suffixes = tuple("." + host for host in tracker_hosts)
 
-    return "\n".join(simplified_elements), str(soup)
\ No newline at end of file
+    async def handle(route):
+        host = urlsplit(route.request.url).hostname or ""
+        if route.request.resource_type in resource_types or host in tracker_hosts or host.endswith(tracker_suffixes):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    await page.route("**/*", handle)
+
+async def simplify_page_for_llm(page: Page, max_elements: int = 80, clip_padding: int = 16) -> tuple[str, Optional[dict]]:
+    # Also returns the viewport-relative union box of the visible interactive elements, for screenshot clipping
+    snapshot = await page.evaluate(LABEL_ELEMENTS_JS, {"padding": clip_padding, "maxElements": max_elements})
+    simplified_elements = "\n".join(f"[{agent_id}] <{tag}> {text}" for agent_id, tag, text, _ in snapshot["elements"])
+    return simplified_elements, snapshot["clip"]
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import importlib
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -25,8 +26,69 @@ STATIC_DIR.mkdir(exist_ok=True)
 SCREENSHOTS_DIR.mkdir(exist_ok=True)
 RESULTS_DIR.mkdir(exist_ok=True)
 
+# --- LLM Response Cache ---
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_DIR = PROJECT_ROOT / ".cache" / "llm"
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 86400)))  # Seconds; pages and models drift, so replays must expire
+
+# --- Web Search Cache (seconds; 0 disables) ---
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "86400"))
+SEARCH_CACHE_DIR = PROJECT_ROOT / ".cache" / "search"
+
+# --- Semantic Action Cache (optional: sentence-transformers + faiss-cpu) ---
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "BAAI/bge-small-en-v1.5")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
 # --- Browser Configuration ---
 VIEWPORT_SIZE = {"width": 1280, "height": 1080}
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "4"))
+SCREENSHOT_CLIP_TO_ELEMENTS = os.getenv("SCREENSHOT_CLIP_TO_ELEMENTS", "true").lower() == "true"
+# Requests of these resource types, or to these hosts (and their subdomains), are aborted. Jobs can opt out per request.
+BLOCK_HEAVY_RESOURCES = os.getenv("BLOCK_HEAVY_RESOURCES", "true").lower() == "true"
+BLOCKED_RESOURCE_TYPES = set(os.getenv("BLOCKED_RESOURCE_TYPES", "image,font,media").split(","))
+BLOCKED_TRACKER_HOSTS = tuple(os.getenv(
+    "BLOCKED_TRACKER_HOSTS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,segment.com,segment.io,hotjar.com,onetrust.com,cookielaw.org"
+).split(","))
+
+# --- Job Admission ---
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", str(BROWSER_POOL_SIZE)))  # One running job per warm browser
+MAX_PENDING_JOBS = int(os.getenv("MAX_PENDING_JOBS", "64"))  # /search answers 429 beyond this backlog
+# Default executor behind asyncio.to_thread (screenshot encoding, embeddings, ...). Sized per uvicorn worker process.
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", str((os.cpu_count() or 1) * 5)))
+
+# --- Server ---
+# uvicorn worker processes. Keep at 1 until job queues/results move to a shared store: SSE streams and /result
+# must hit the worker that owns the job. Each worker also runs its own browser pool and thread pool.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# --- Job Retention ---
+JOB_QUEUE_GRACE = int(os.getenv("JOB_QUEUE_GRACE", "300"))  # Status queues are dropped this long after the job ends
+STATUS_QUEUE_MAX = int(os.getenv("STATUS_QUEUE_MAX", "1024"))  # Per job; the oldest status is dropped when a slow client falls behind
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "86400"))  # In-memory results; /result falls back to the file on disk
+RESULTS_RETENTION = int(os.getenv("RESULTS_RETENTION", str(7 * 86400)))  # Result files older than this are deleted
+
+# --- Prompt Budgets ---
+MAX_PROMPT_ELEMENTS = int(os.getenv("MAX_PROMPT_ELEMENTS", "80"))
+MAX_HISTORY_CHARS = int(os.getenv("MAX_HISTORY_CHARS", "2000"))
+
+# --- LLM HTTP Clients ---
+# One pooled client per SDK: keep-alive TLS sessions and HTTP/2 multiplexing across calls
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE = 50
+
+def build_sdk_http_client(client_cls):
+    # SDKs may bundle different httpx flavours (newer anthropic/openai use httpx2), so Limits must come
+    # from the package behind the SDK's own DefaultAsyncHttpxClient, never from a shared httpx client
+    async_client = next(base for base in client_cls.__mro__ if base.__name__ == "AsyncClient")
+    httpx_pkg = importlib.import_module(async_client.__module__.split(".")[0])
+    limits = httpx_pkg.Limits(max_keepalive_connections=HTTP_MAX_KEEPALIVE, max_connections=HTTP_MAX_CONNECTIONS)
+    try:
+        return client_cls(http2=True, limits=limits)
+    except ImportError:
+        print("Warning: 'h2' library not installed. LLM requests will use HTTP/1.1.")
+        return client_cls(limits=limits)
 
 # --- LLM Client Initialization ---
 anthropic_client = None
@@ -35,8 +97,8 @@ openai_client = None
 
 try:
     if ANTHROPIC_API_KEY:
-        from anthropic import Anthropic
-        anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+        from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+        anthropic_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=build_sdk_http_client(DefaultAsyncHttpxClient))
     else:
         print("Warning: ANTHROPIC_API_KEY not found. Anthropic provider will be unavailable.")
 except ImportError:
@@ -44,8 +106,8 @@ except ImportError:
 
 try:
     if GROQ_API_KEY:
-        from groq import Groq
-        groq_client = Groq(api_key=GROQ_API_KEY)
+        from groq import AsyncGroq, DefaultAsyncHttpxClient
+        groq_client = AsyncGroq(api_key=GROQ_API_KEY, http_client=build_sdk_http_client(DefaultAsyncHttpxClient))
     else:
         print("Warning: GROQ_API_KEY not found. Groq provider will be unavailable.")
 except ImportError:
@@ -53,10 +115,21 @@ except ImportError:
 
 try:
     if OPENAI_API_KEY:
-        from openai import OpenAI
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=build_sdk_http_client(DefaultAsyncHttpxClient))
     else:
         print("Warning: OPENAI_API_KEY not found. OpenAI provider will be unavailable.")
 except ImportError:
     print("Warning: 'openai' library not installed. OpenAI provider will be unavailable.")
 
+llm_cache = None
+search_cache = None
+
+try:
+    from diskcache import Cache
+    if LLM_CACHE_ENABLED:
+        llm_cache = Cache(str(LLM_CACHE_DIR))
+    if SEARCH_CACHE_TTL > 0:
+        search_cache = Cache(str(SEARCH_CACHE_DIR))
+except ImportError:
+    print("Warning: 'diskcache' library not installed. LLM response and web search caching will be unavailable.")
@@ -1,53 +1,84 @@
 import asyncio
+import os
+import time
 import uuid
-import json
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
+import aiofiles
+from cachetools import TTLCache
+import orjson
 import uvicorn
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from playwright.sync_api import sync_playwright, Browser
+from playwright.async_api import Browser, TimeoutError as PlaywrightTimeoutError
 from langgraph.errors import GraphRecursionError
 
 from agent.state import AgentState
 from agent.graph import create_graph, set_push_status_update
-from config.settings import SCREENSHOTS_DIR, RESULTS_DIR, STATIC_DIR, VIEWPORT_SIZE
-from browser.utils import get_current_timestamp
+from config.settings import (
+    SCREENSHOTS_DIR, RESULTS_DIR, STATIC_DIR, VIEWPORT_SIZE, MAX_CONCURRENT_JOBS, MAX_PENDING_JOBS,
+    THREAD_POOL_SIZE, BLOCK_HEAVY_RESOURCES, BLOCKED_RESOURCE_TYPES, BLOCKED_TRACKER_HOSTS, JOB_QUEUE_GRACE,
+    JOB_RESULT_TTL, RESULTS_RETENTION, WEB_CONCURRENCY, STATUS_QUEUE_MAX,
+    anthropic_client, groq_client, openai_client
+)
+from browser.utils import get_current_timestamp, block_heavy_resources
+from browser.pool import BROWSER_POOL
 
 # IMPROVE: Add basic logging
 import logging
 logging.basicConfig(level=logging.INFO)
 
-# --- CRITICAL FIX: Restore the robust import for undetected-playwright ---
-try:
-    from undetected_playwright.sync import Tarnished
-except ImportError:
-    try:
-        from undetected_playwright import Tarnished
-    except ImportError:
-        logging.warning("undetected_playwright not found. Stealth features disabled.")
-        Tarnished = None
+# undetected_playwright is only needed by stealth jobs, so it is imported on first use rather than at startup
+_MALENIA = None
+_MALENIA_RESOLVED = False
+
+def get_stealth():
+    # Malenia is undetected_playwright's async-API counterpart of Tarnished. Tarnished.apply_stealth calls the
+    # sync add_init_script, which on an async BrowserContext only creates coroutines that are never awaited.
+    global _MALENIA, _MALENIA_RESOLVED
+    if not _MALENIA_RESOLVED:
+        try:
+            from undetected_playwright import Malenia
+        except ImportError:
+            logging.warning("undetected_playwright not found. Stealth features disabled.")
+            Malenia = None
+        _MALENIA, _MALENIA_RESOLVED = Malenia, True
+    return _MALENIA
 
 LLMProvider = str
 
 app = FastAPI(title="Universal Web Agent")
 
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
-app.mount("/screenshots", StaticFiles(directory=SCREENSHOTS_DIR), name="screenshots")
 
-JOB_QUEUES = {}
-JOB_RESULTS = {}
+JOB_QUEUES = {}  # No TTL: a queued/running job must keep its queue; run_job drops it JOB_QUEUE_GRACE after the end
+JOB_RESULTS = TTLCache(maxsize=4096, ttl=JOB_RESULT_TTL)  # Bounded so a long-running server doesn't keep every result
+JOB_TASKS = set()  # Strong refs so running jobs are not garbage-collected
+JOB_SEM = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+PENDING_JOBS = asyncio.Queue(maxsize=MAX_PENDING_JOBS)
+
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+_SSE_KEEPALIVE = b": keep-alive\n\n"
 
 def push_status(job_id: str, msg: str, details: dict = None):
     q = JOB_QUEUES.get(job_id)
     if q:
         entry = {"ts": get_current_timestamp(), "msg": msg}
         if details: entry["details"] = details
-        try: q.put_nowait(entry)
-        except asyncio.QueueFull: logging.warning(f"Queue full for job {job_id}.")
+        # Serialize once here so every SSE subscriber just forwards the bytes
+        encoded = _SSE_PREFIX + orjson.dumps(entry) + _SSE_SUFFIX
+        try: q.put_nowait((entry, encoded))
+        except asyncio.QueueFull:
+            logging.warning(f"Queue full for job {job_id}; dropping the oldest status.")
+            q.get_nowait()
+            q.put_nowait((entry, encoded))
 
 set_push_status_update(push_status)
 
@@ -56,53 +87,62 @@ class SearchRequest(BaseModel):
     query: str
     llm_provider: LLMProvider = "anthropic"
     stealth: bool = False  # NEW: Default to False (normal Playwright)
+    block_resources: bool = BLOCK_HEAVY_RESOURCES  # Set False when the task depends on images or web fonts
+    ready_selector: Optional[str] = None  # DOM hook the first step needs; the job starts as soon as it appears
 
 agent_graph = create_graph()
 
-def run_job(job_id: str, payload: dict):
+async def run_job(job_id: str, url: str, query: str, llm_provider: LLMProvider, stealth: bool = False,
+                  block_resources: bool = BLOCK_HEAVY_RESOURCES, ready_selector: Optional[str] = None):
     push_status(job_id, "job_initiated")
     browser: Browser = None
+    context = None
     final_state_dict = {}
-    stealth_enabled = payload.get("stealth", False)
+    stealth_enabled = stealth
     try:
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            context = browser.new_context(
-                viewport=VIEWPORT_SIZE,
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-            )
-            
-            # UPDATED: Apply stealth only if requested and available
-            if stealth_enabled:
-                if Tarnished:
-                    Tarnished.apply_stealth(context)
-                    logging.info(f"Stealth mode enabled for job {job_id}")
-                else:
-                    logging.warning(f"Stealth requested but undetected_playwright not available for job {job_id}. Using normal mode.")
-                    stealth_enabled = False  # Fallback to normal
-            
-            page = context.new_page()
-            page.goto(payload["url"], wait_until='domcontentloaded', timeout=90000)
-            
-            page.wait_for_selector("body", timeout=15000)
-            page.wait_for_timeout(5000)
-            
-            push_status(job_id, "job_started", {"provider": payload["llm_provider"], "query": payload["query"], "stealth": stealth_enabled})
-            
-            job_artifacts_dir = SCREENSHOTS_DIR / job_id
-            job_artifacts_dir.mkdir(exist_ok=True)
-            
-            initial_state = AgentState(
-                job_id=job_id, query=payload["query"], url=page.url, provider=payload["llm_provider"],
-                plan_details={}, current_task="", page_content="", modified_html_for_action="",
-                results=[], generated_credentials={}, screenshots=[], job_artifacts_dir=job_artifacts_dir,
-                step=1, max_steps=40, history=[], execution_summary=[], last_action={},
-                last_action_outcome="", retry_count=0, last_error="", research_summary=""
-            )
-
-            config = {"configurable": {"page": page}, "recursion_limit": 100}
-            
-            final_state_dict = agent_graph.invoke(initial_state, config=config)
+        browser = await BROWSER_POOL.acquire()
+        context = await browser.new_context(
+            viewport=VIEWPORT_SIZE,
+            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
+        )
+        
+        # UPDATED: Apply stealth only if requested and available
+        if stealth_enabled:
+            Malenia = get_stealth()
+            if Malenia:
+                await Malenia.apply_stealth(context)
+                logging.info(f"Stealth mode enabled for job {job_id}")
+            else:
+                logging.warning(f"Stealth requested but undetected_playwright not available for job {job_id}. Using normal mode.")
+                stealth_enabled = False  # Fallback to normal
+        
+        page = await context.new_page()
+        if block_resources:
+            await block_heavy_resources(page, BLOCKED_RESOURCE_TYPES, BLOCKED_TRACKER_HOSTS)
+        await page.goto(url, wait_until='domcontentloaded', timeout=90000)
+        
+        await page.wait_for_selector(ready_selector or "body", timeout=15000)
+        try:
+            await page.wait_for_load_state("networkidle", timeout=8000)
+        except PlaywrightTimeoutError:
+            pass  # Long-polling/streaming pages never go idle; the DOM is already there
+        
+        push_status(job_id, "job_started", {"provider": llm_provider, "query": query, "stealth": stealth_enabled})
+        
+        job_artifacts_dir = SCREENSHOTS_DIR / job_id
+        job_artifacts_dir.mkdir(exist_ok=True)
+        
+        initial_state = AgentState(
+            job_id=job_id, query=query, url=page.url, provider=llm_provider,
+            plan_details={}, formatted_plan="", current_task="",
+            results=[], generated_credentials={}, screenshots=[], job_artifacts_dir=job_artifacts_dir,
+            step=1, max_steps=40, history=deque(maxlen=5), execution_summary=[], last_action={},
+            last_action_outcome="", retry_count=0, last_error="", research_summary=""
+        )
+
+        config = {"configurable": {"page": page}, "recursion_limit": 100}
+        
+        final_state_dict = await agent_graph.ainvoke(initial_state, config=config)
 
     except (Exception, GraphRecursionError) as e:
         error_message = f"An unexpected error occurred: {str(e)}"
@@ -120,20 +160,81 @@ def run_job(job_id: str, payload: dict):
         }
         
         results_file = RESULTS_DIR / f"{job_id}.json"
-        with open(results_file, "w") as f:
-            json.dump(result_data, f, indent=2)
+        tmp_file = results_file.with_suffix(".json.tmp")
+        try:
+            # Write-then-rename so /result never reads a half-written file
+            async with aiofiles.open(tmp_file, "wb") as f:
+                await f.write(orjson.dumps(result_data, option=orjson.OPT_INDENT_2))
+            os.replace(tmp_file, results_file)
+        except Exception as e:
+            logging.error(f"Could not write results file for job {job_id}: {e}")
 
         JOB_RESULTS[job_id] = result_data
         push_status(job_id, "job_done" if not result_data.get("error") else "job_failed")
-        if browser: browser.close()
+        asyncio.get_running_loop().call_later(JOB_QUEUE_GRACE, JOB_QUEUES.pop, job_id, None)
+        if context:
+            try: await context.close()
+            except Exception as e: logging.warning(f"Could not close browser context for job {job_id}: {e}")
+        if browser: await BROWSER_POOL.release(browser)
+
+async def dispatch_jobs():
+    # Starts queued jobs only while a concurrency slot is free, so excess load backs up into PENDING_JOBS
+    while True:
+        # Take the slot first: a job dequeued while waiting for one would sit outside the MAX_PENDING_JOBS bound
+        await JOB_SEM.acquire()
+        try:
+            job_id, req = await PENDING_JOBS.get()
+        except BaseException:
+            JOB_SEM.release()
+            raise
+        task = asyncio.create_task(run_job(
+            job_id, req.url, req.query, req.llm_provider, req.stealth, req.block_resources, req.ready_selector
+        ))
+        JOB_TASKS.add(task)
+        task.add_done_callback(JOB_TASKS.discard)
+        task.add_done_callback(lambda _: JOB_SEM.release())
+
+def prune_result_files():
+    cutoff = time.time() - RESULTS_RETENTION
+    # .json.tmp files are left behind when the write-then-rename in run_job fails midway
+    for result_file in (*RESULTS_DIR.glob("*.json"), *RESULTS_DIR.glob("*.json.tmp")):
+        try:
+            if result_file.stat().st_mtime < cutoff: result_file.unlink()
+        except OSError as e:
+            logging.warning(f"Could not prune result file {result_file.name}: {e}")
+
+async def prune_results_periodically():
+    while True:
+        await asyncio.to_thread(prune_result_files)
+        await asyncio.sleep(3600)
+
+@app.on_event("startup")
+async def on_startup():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="job"))
+    app.state.dispatcher = asyncio.create_task(dispatch_jobs())
+    app.state.pruner = asyncio.create_task(prune_results_periodically())
+    try:
+        await BROWSER_POOL.start()  # Warm up the pooled browsers before the first job
+    except Exception as e:
+        logging.warning(f"Browser pool warm-up failed; retrying on the first job. Error: {e}")
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.dispatcher.cancel()
+    app.state.pruner.cancel()
+    await BROWSER_POOL.close()
+    for client in (anthropic_client, groq_client, openai_client):
+        if client: await client.close()  # Also closes the SDK's pooled HTTP client
 
 @app.post("/search")
 async def start_search(req: SearchRequest):
+    if PENDING_JOBS.full():
+        raise HTTPException(status_code=429, detail="Too many pending jobs. Try again later.")
     job_id = str(uuid.uuid4())
-    JOB_QUEUES[job_id] = asyncio.Queue()
+    JOB_QUEUES[job_id] = asyncio.Queue(maxsize=STATUS_QUEUE_MAX)
     push_status(job_id, "job_queued")
-    loop = asyncio.get_event_loop()
-    loop.run_in_executor(None, run_job, job_id, req.dict())
+    PENDING_JOBS.put_nowait((job_id, req))
     return {"job_id": job_id, "stream_url": f"/stream/{job_id}", "result_url": f"/result/{job_id}"}
 
 @app.get("/stream/{job_id}")
@@ -143,10 +244,14 @@ async def stream_status(job_id: str):
     async def event_generator():
         while True:
             try:
-                msg = await asyncio.wait_for(q.get(), timeout=120)
-                yield f"data: {json.dumps(msg)}\n\n"
-                if msg["msg"] in ("job_done", "job_failed"): break
-            except asyncio.TimeoutError: yield ": keep-alive\n\n"
+                batch = [await asyncio.wait_for(q.get(), timeout=120)]
+                # Coalesce whatever else is already queued into a single write
+                while True:
+                    try: batch.append(q.get_nowait())
+                    except asyncio.QueueEmpty: break
+                yield b"".join(encoded for _, encoded in batch)
+                if any(entry["msg"] in ("job_done", "job_failed") for entry, _ in batch): break
+            except asyncio.TimeoutError: yield _SSE_KEEPALIVE
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 @app.get("/result/{job_id}")
@@ -155,13 +260,24 @@ async def get_result(job_id: str):
     if not result:
         result_file = RESULTS_DIR / f"{job_id}.json"
         if result_file.exists():
-            with open(result_file, "r") as f: return JSONResponse(json.load(f))
+            return FileResponse(result_file, media_type="application/json")  # sendfile, no read/parse in Python
         return JSONResponse({"status": "pending"}, status_code=202)
-    return JSONResponse(result)
+    return Response(content=orjson.dumps(result), media_type="application/json")
+
+@app.get("/screenshots/{job_id}/{name}")
+async def get_screenshot(job_id: str, name: str):
+    if ".." in job_id or ".." in name or Path(job_id).name != job_id or Path(name).name != name:
+        raise HTTPException(status_code=404, detail="Screenshot not found")
+    p = SCREENSHOTS_DIR / job_id / name
+    if not await asyncio.to_thread(p.is_file):
+        raise HTTPException(status_code=404, detail="Screenshot not found")
+    # Screenshots are write-once, so clients and proxies may cache them indefinitely
+    return FileResponse(p, headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
 @app.get("/")
 async def client_ui():
     return FileResponse(STATIC_DIR / "test_client.html")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # "auto" picks uvloop and httptools when installed (uvicorn[standard]), and falls back to asyncio/h11 where they aren't
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WEB_CONCURRENCY, loop="auto", http="auto")
\ No newline at end of file